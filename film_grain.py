@@ -1,9 +1,14 @@
 # Copyright (c) 2024 Jonathan S. Pollack (https://github.com/JPPhoto)
 
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from typing import Optional
 
+import cv2
 import numpy as np
-from PIL import Image, ImageChops, ImageFilter
+from PIL import Image
 
 from invokeai.invocation_api import (
     SEED_MAX,
@@ -18,8 +23,171 @@ from invokeai.invocation_api import (
     invocation,
 )
 
+# The two noise layers are independent until they are blended, and both the NumPy fills and OpenCV's blur release the
+# GIL, so they are generated side by side on a shared pool.
+_NOISE_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="film_grain")
+
+# Work that is independent per row (noise draws and the blend) is split into horizontal bands and spread over every
+# core. Tasks on this pool never wait on other tasks, so it is safe to use from inside the noise pool.
+_BAND_WORKERS = os.cpu_count() or 1
+_BAND_EXECUTOR = ThreadPoolExecutor(max_workers=_BAND_WORKERS, thread_name_prefix="film_grain_band")
+_BLEND_TILE_SAMPLES = 256 * 1024
+
+# Blurred noise for seeded layers is kept between invocations so that tweaking the other layer or re-running a graph
+# skips straight to the blend; entries are evicted least recently used first once the byte budget is exceeded
+_NOISE_CACHE: OrderedDict[tuple, np.ndarray] = OrderedDict()
+_NOISE_CACHE_LOCK = Lock()
+_NOISE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+_NOISE_TERMS = 4
+_NOISE_BAND_HEIGHT = 256
+_NOISE_MEAN = _NOISE_TERMS * 255 / 2
+_NOISE_STD = (_NOISE_TERMS * (256**2 - 1) / 12) ** 0.5
+
+
+def _make_noise(seed: int, amount: int, blur: float, height: int, width: int, channels: int) -> np.ndarray:
+    """Returns a blurred (height, width, channels) noise layer centered on mid-grey"""
+
+    # Heavily blurred noise has no detail finer than the blur radius, so it is generated and blurred at a reduced
+    # resolution and upscaled. Blurred noise weakens in proportion to the radius and bilinear upscaling weakens it
+    # further depending on how correlated neighbouring samples are, so the amount is adjusted to keep the same strength.
+    factor = int(blur) if blur >= 2 else 1
+    shape = (height, width, channels)
+    gain = 1.0
+    if factor > 1:
+        shape = (-(-height // factor), -(-width // factor), channels)
+        blur /= factor
+        gain = 3 / (factor * (2 + np.exp(-1 / (4 * blur**2))))
+
+    # Film grain doesn't need exact Gaussian tails, so the noise is a sum of uniform bytes (central limit theorem),
+    # which is much cheaper to draw than standard normals and is rescaled to the same mean and variance. Each band of
+    # rows draws from its own stream spawned from the seed, so bands are generated in parallel and the result only
+    # depends on the seed and the image size, not on the number of cores.
+    noise = np.empty(shape, dtype=np.float32)
+    bands = [slice(y, y + _NOISE_BAND_HEIGHT) for y in range(0, shape[0], _NOISE_BAND_HEIGHT)]
+
+    def draw(rows: slice, seed_sequence: np.random.SeedSequence) -> None:
+        rng = np.random.Generator(np.random.SFC64(seed_sequence))
+        uniforms = rng.integers(0, 256, size=(_NOISE_TERMS, *noise[rows].shape), dtype=np.uint8)
+        total = uniforms[0].astype(np.uint16)
+        for uniform in uniforms[1:]:
+            np.add(total, uniform, out=total)
+        np.copyto(noise[rows], total)
+
+    list(_BAND_EXECUTOR.map(draw, bands, np.random.SeedSequence(seed).spawn(len(bands))))
+
+    # The blur is linear, so scaling and centering are folded into it: the scale goes into one of the separable
+    # kernels and the offset is applied as the filter's delta, all in place on the float32 noise
+    scale = 127.5 * (amount / 800.0) / _NOISE_STD * gain
+    if blur > 0:
+        # Pillow's GaussianBlur radius is the standard deviation, so it is used as sigma directly
+        kernel = cv2.getGaussianKernel(max(3, int(2 * round(3 * blur) + 1)), blur, ktype=cv2.CV_32F)
+    else:
+        kernel = np.ones((1, 1), dtype=np.float32)
+    cv2.sepFilter2D(
+        noise,
+        -1,
+        kernel * np.float32(scale),
+        kernel,
+        dst=noise,
+        delta=127.5 - _NOISE_MEAN * scale,
+        borderType=cv2.BORDER_REFLECT,
+    )
+
+    # Clipping and quantizing share one pass by clipping straight into the uint8 output
+    grain = np.empty(shape, dtype=np.uint8)
+    np.clip(noise, 0, 255, out=grain, casting="unsafe")
+
+    if factor > 1:
+        # OpenCV drops the channel axis of single channel images
+        grain = cv2.resize(grain, (width, height), interpolation=cv2.INTER_LINEAR).reshape(height, width, channels)
+
+    return grain
+
+
+def _noise_cached(
+    seed: Optional[int], amount: int, blur: float, height: int, width: int, channels: int
+) -> np.ndarray:
+    """Returns a noise layer from _make_noise, reusing a previous result for the same seed and settings"""
+
+    if seed is None:
+        return _make_noise(get_random_seed(), amount, blur, height, width, channels)
+
+    key = (seed, amount, round(blur, 4), height, width, channels)
+    with _NOISE_CACHE_LOCK:
+        noise = _NOISE_CACHE.get(key)
+        if noise is not None:
+            _NOISE_CACHE.move_to_end(key)
+            return noise
+
+    noise = _make_noise(seed, amount, blur, height, width, channels)
+    noise.flags.writeable = False
+
+    with _NOISE_CACHE_LOCK:
+        _NOISE_CACHE[key] = noise
+        cache_bytes = sum(cached.nbytes for cached in _NOISE_CACHE.values())
+        while cache_bytes > _NOISE_CACHE_MAX_BYTES and len(_NOISE_CACHE) > 1:
+            cache_bytes -= _NOISE_CACHE.popitem(last=False)[1].nbytes
+
+    return noise
+
+
+def _build_overlay_lut() -> np.ndarray:
+    """Returns a 256x256 table of ImageChops.overlay results indexed by [image, noise]"""
+
+    image = np.arange(256, dtype=np.uint16)[:, np.newaxis]
+    noise = np.arange(256, dtype=np.uint16)[np.newaxis, :]
+    return np.where(image < 128, image * noise // 127, 255 - (255 - image) * (255 - noise) // 127).astype(np.uint8)
+
+
+_OVERLAY_LUT = _build_overlay_lut()
+
+
+def _overlay(image: np.ndarray, *noises: np.ndarray) -> None:
+    """Overlays noise layers onto an image in place, matching ImageChops.overlay applied once per layer"""
+
+    # The image is blended in small tiles of rows so that each tile and its lookup indices stay in cache while every
+    # layer is applied, instead of streaming the whole image through memory once per layer
+    lut = _OVERLAY_LUT.reshape(-1)
+    tile_height = max(1, _BLEND_TILE_SAMPLES // (image.shape[1] * image.shape[2]))
+
+    def blend(rows: slice) -> None:
+        tile = image[rows]
+        index = np.empty(tile.shape, dtype=np.uint16)
+        blended = np.empty(tile.shape, dtype=np.uint8)
+        for noise in noises:
+            np.left_shift(tile, 8, out=index, dtype=np.uint16)
+            np.bitwise_or(index, noise[rows], out=index)
+            lut.take(index, out=blended, mode="wrap")
+            tile = blended
+        image[rows] = blended
+
+    list(_BAND_EXECUTOR.map(blend, [slice(y, y + tile_height) for y in range(0, image.shape[0], tile_height)]))
+
+
+def _add_film_grain(
+    image: Image.Image, layers: tuple[tuple[Optional[int], int, float], ...], channels: int
+) -> Image.Image:
+    """Overlays a noise layer with the given number of channels for each (seed, amount, blur) onto an image"""
 
-@invocation("film_grain", title="FilmGrain", tags=["film_grain"], version="1.1.2")
+    # A layer with no noise leaves the image unchanged, so it is skipped entirely
+    noises = [
+        _NOISE_EXECUTOR.submit(_noise_cached, seed, amount, blur, image.size[1], image.size[0], channels)
+        for seed, amount, blur in layers
+        if amount > 0
+    ]
+    noises = [noise.result() for noise in noises]
+
+    if not noises:
+        return image
+
+    pixels = np.array(image)
+    # Only the colour planes are blended, so an alpha channel passes through untouched
+    _overlay(pixels[:, :, :3], *noises)
+    return Image.frombuffer(image.mode, image.size, pixels, "raw", image.mode, 0, 1)
+
+
+@invocation("film_grain", title="FilmGrain", tags=["film_grain"], version="1.2.0")
 class FilmGrainInvocation(BaseInvocation, WithMetadata, WithBoard):
     """Adds film grain to an image"""
 
@@ -33,35 +201,15 @@ class FilmGrainInvocation(BaseInvocation, WithMetadata, WithBoard):
 
     def invoke(self, context: InvocationContext) -> ImageOutput:
         image = context.images.get_pil(self.image.image_name)
-        mode = image.mode
-
-        if mode == "RGBA":
-            image = image.convert("RGB")
-
-        rng = np.random.default_rng(seed=self.seed_1 if self.seed_1 is not None else get_random_seed())
-        noise_1 = rng.normal(0, 1, (image.size[1], image.size[0], 3)) * 127.5 * (self.amount_1 / 800.0)
-        noise_1 = noise_1 + 127.5
-        noise_1 = Image.fromarray(noise_1.astype("uint8"), "RGB")
-        noise_1 = noise_1.filter(ImageFilter.GaussianBlur(radius=self.blur_1))
-
-        rng = np.random.default_rng(seed=self.seed_2 if self.seed_2 is not None else get_random_seed())
-        noise_2 = rng.normal(0, 1, (image.size[1], image.size[0], 3)) * 127.5 * (self.amount_2 / 800.0)
-        noise_2 = noise_2 + 127.5
-        noise_2 = Image.fromarray(noise_2.astype("uint8"), "RGB")
-        noise_2 = noise_2.filter(ImageFilter.GaussianBlur(radius=self.blur_2))
-
-        image = ImageChops.overlay(image, noise_1)
-        image = ImageChops.overlay(image, noise_2)
-
-        if mode == "RGBA":
-            image = image.convert("RGBA")
+        layers = ((self.seed_1, self.amount_1, self.blur_1), (self.seed_2, self.amount_2, self.blur_2))
+        image = _add_film_grain(image, layers, channels=3)
 
         image_dto = context.images.save(image=image)
 
         return ImageOutput.build(image_dto)
 
 
-@invocation("monochrome_film_grain", title="MonochromeFilmGrain", tags=["film_grain", "monochrome"], version="1.1.2")
+@invocation("monochrome_film_grain", title="MonochromeFilmGrain", tags=["film_grain", "monochrome"], version="1.2.0")
 class MonochromeFilmGrainInvocation(BaseInvocation, WithMetadata, WithBoard):
     """Adds monochrome film grain to an image"""
 
@@ -75,30 +223,8 @@ class MonochromeFilmGrainInvocation(BaseInvocation, WithMetadata, WithBoard):
 
     def invoke(self, context: InvocationContext) -> ImageOutput:
         image = context.images.get_pil(self.image.image_name)
-        mode = image.mode
-
-        if mode == "RGBA":
-            image = image.convert("RGB")
-
-        rng = np.random.default_rng(seed=self.seed_1 if self.seed_1 is not None else get_random_seed())
-        noise_1 = rng.normal(0, 1, (image.size[1], image.size[0])) * 127.5 * (self.amount_1 / 800.0)
-        noise_1 = noise_1 + 127.5
-        noise_1 = Image.fromarray(noise_1.astype("uint8"), "L")
-        noise_1 = noise_1.filter(ImageFilter.GaussianBlur(radius=self.blur_1))
-        noise_1 = noise_1.convert("RGB")
-
-        rng = np.random.default_rng(seed=self.seed_2 if self.seed_2 is not None else get_random_seed())
-        noise_2 = rng.normal(0, 1, (image.size[1], image.size[0])) * 127.5 * (self.amount_2 / 800.0)
-        noise_2 = noise_2 + 127.5
-        noise_2 = Image.fromarray(noise_2.astype("uint8"), "L")
-        noise_2 = noise_2.filter(ImageFilter.GaussianBlur(radius=self.blur_2))
-        noise_2 = noise_2.convert("RGB")
-
-        image = ImageChops.overlay(image, noise_1)
-        image = ImageChops.overlay(image, noise_2)
-
-        if mode == "RGBA":
-            image = image.convert("RGBA")
+        layers = ((self.seed_1, self.amount_1, self.blur_1), (self.seed_2, self.amount_2, self.blur_2))
+        image = _add_film_grain(image, layers, channels=1)
 
         image_dto = context.images.save(image=image)
 